@@ -7,7 +7,7 @@ Refactored DeepFace CLI + WebSocket server for use as a child process
 WebSocket worker.
 
 Modes:
-    - CLI subcommands (default): analyze, verify, detect, find.
+    - CLI subcommands (default): analyze, verify, detect, find, pipeline.
     - Serve mode:
       * `serve` command starts a WebSocket server (default host=127.0.0.1)
       * Use `--port` to choose the port
@@ -18,22 +18,59 @@ Protocol (WebSocket):
 
     * Responses are JSON messages with structure:
         { "requestId": <id>, "status": "ok|error", "command": "<cmd>", "data": <payload> }
+      Error payloads are {"message": ..., "traceback": ...}; the traceback is
+      null unless DEEPFACE_CLI_DEBUG=1 is set.
+
+    * With `serve --shm`, analyze/detect/pipeline also accept the frame as a shared-memory
+      block instead of a path (BGR pixels, as DeepFace expects for arrays):
+        {"cmd":"analyze", "frame_shm": {"name":"df_frame", "shape":[480,640,3], "dtype":"uint8"}}
+
+    * `pipeline` runs several ops on one frame with a single face detection:
+        {"cmd":"pipeline", "frame":"path1", "ops":["detect","analyze","find"], "db":"faces/"}
 
 Design:
     - Always processes one frame per request (no bulk).
     - stdout is NOT used by WebSocket mode. For CLI, stdout contains the final JSON.
     - stderr is reserved for logs / debug statements.
+    - Messages are parsed and encoded with orjson (numpy arrays natively) when
+      installed, falling back to json (+ make_serializable).
     - safe_call helper retries calls if DeepFace API has different kwargs.
+    - serve runs DeepFace calls on a thread (default) or process pool
+      (--executor / --workers) so a slow request never blocks other clients.
+    - find requests arriving within --batch-ms of each other share one
+      DeepFace.represent call for their query images (a find with no other
+      find active is not delayed).
+    - find keeps DB embeddings in memory and in sidecar files (.pkl index +
+      memory-mapped .npy matrix) inside the DB folder, so only new/changed
+      images are embedded again and restarts load nothing up front. A DB
+      folder is rescanned for changes at most every DB_RESCAN_S. DBs of
+      ANN_MIN_SIZE faces or more are searched through an HNSW (hnswlib) or
+      FAISS IVF index when installed; pick one with "index" / --index.
+      "quantize" / --quantize stores the FAISS index as int8 codes (index
+      "auto" or "faiss" only; smaller DBs are still scanned as float32).
 """
 
+import glob
+import hashlib
 import logging
+import math
 import os
 import sys
 import json
+import uuid
+import pickle
+import struct
+import tempfile
 import argparse
 import asyncio
+import threading
+import time
 import traceback
-from typing import Any, Dict
+import multiprocessing
+import contextlib
+import concurrent.futures
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterator, List, Tuple
 
 # third-party
 try:
@@ -49,6 +86,43 @@ except Exception:
     raise
 
 import numpy as np
+import cv2   # installed with deepface
+
+# optional: approximate nearest-neighbour search for large find DBs
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# optional: C-level JSON encoding of numpy payloads
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# optional: JIT-compiled brute-force scan for find when no ANN index is used
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# optional: libjpeg-turbo decode (needs the turbojpeg wrapper + native library)
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _TURBOJPEG = TurboJPEG()
+except Exception:
+    _TURBOJPEG = None
+
+# optional: faster event loop for serve mode (not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # ----------------------------
 # PyInstaller support
@@ -62,6 +136,9 @@ else:
 # ----------------------------
 # Utilities
 # ----------------------------
+# DEEPFACE_CLI_DEBUG=1 adds full tracebacks to WS error responses and logs
+DEBUG = os.environ.get("DEEPFACE_CLI_DEBUG", "") not in ("", "0")
+
 def eprint(*args, **kwargs):
     """Print to stderr for logs."""
     print(*args, file=sys.stderr, **kwargs)
@@ -87,6 +164,38 @@ def make_serializable(obj: Any) -> Any:
     except Exception:
         return str(obj)
 
+def _orjson_default(obj: Any) -> Any:
+    """Handle the few types orjson does not encode natively."""
+    if isinstance(obj, (bytes, bytearray)):
+        try:
+            return obj.decode("utf-8")
+        except Exception:
+            return list(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, np.ndarray):      # non-contiguous or unsupported dtype
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def encode_json_bytes(obj: Any) -> bytes:
+    """Serialize a command result / response to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(make_serializable(obj), ensure_ascii=False).encode("utf-8")
+
+def decode_json(raw: Any) -> Any:
+    """Parse an inbound message (str or bytes); raises json.JSONDecodeError."""
+    if orjson is not None:
+        return orjson.loads(raw)   # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    return json.loads(raw)
+
+def encode_json(obj: Any) -> str:
+    """Serialize a command result / response to a JSON string."""
+    return encode_json_bytes(obj).decode("utf-8")
+
 def safe_call(func, kwargs: Dict[str, Any]):
     """Call DeepFace function with kwargs, dropping unsupported args if necessary."""
     try:
@@ -104,10 +213,656 @@ def safe_call(func, kwargs: Dict[str, Any]):
                         pass
         raise
 
+# ----------------------------
+# Image loading
+# ----------------------------
+JPEG_EXTS = (".jpg", ".jpeg")
+
+def jpeg_orientation(data: bytes) -> int:
+    """EXIF Orientation tag of a JPEG (1, i.e. upright, when absent or unreadable)."""
+    try:
+        pos = 2
+        while pos + 4 <= len(data) and data[pos] == 0xFF:
+            marker = data[pos + 1]
+            if marker == 0xDA:   # start of scan: no metadata past here
+                break
+            size = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            if marker == 0xE1 and data[pos + 4:pos + 10] == b"Exif\0\0":
+                tiff = pos + 10
+                endian = "<" if data[tiff:tiff + 2] == b"II" else ">"
+                ifd = tiff + struct.unpack(endian + "I", data[tiff + 4:tiff + 8])[0]
+                for i in range(struct.unpack(endian + "H", data[ifd:ifd + 2])[0]):
+                    tag = ifd + 2 + 12 * i
+                    if struct.unpack(endian + "H", data[tag:tag + 2])[0] == 0x0112:
+                        return struct.unpack(endian + "H", data[tag + 8:tag + 10])[0]
+                return 1
+            pos += 2 + size
+    except struct.error:
+        pass
+    return 1
+
+def load_image(img: Any) -> Any:
+    """
+    Decode a JPEG path to a BGR ndarray with libjpeg-turbo when available.
+
+    Anything else (other formats, arrays, turbojpeg missing or failing, or a
+    rotated EXIF orientation, which turbojpeg ignores) is returned unchanged
+    for DeepFace to load itself.
+    """
+    if _TURBOJPEG is None or not isinstance(img, str) or not img.lower().endswith(JPEG_EXTS):
+        return img
+    try:
+        with open(img, "rb") as fh:
+            data = fh.read()
+        if jpeg_orientation(data) != 1:
+            return img
+        return _TURBOJPEG.decode(data, pixel_format=TJPF_BGR)
+    except Exception:
+        return img
+
+def decode_image(data: bytes, path: str) -> Any:
+    """Decode already-read file bytes to a BGR ndarray (the path if undecodable)."""
+    if _TURBOJPEG is not None and path.lower().endswith(JPEG_EXTS) and jpeg_orientation(data) == 1:
+        try:
+            return _TURBOJPEG.decode(data, pixel_format=TJPF_BGR)
+        except Exception:
+            pass
+    # cv2.imdecode applies EXIF orientation, like DeepFace's own cv2.imread
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return path if img is None else img
+
+IO_WORKERS = 8
+READ_CHUNK = 64
+_IO_POOL: concurrent.futures.ThreadPoolExecutor = None
+
+def _read_file(path: str) -> Any:
+    try:
+        with open(path, "rb") as fh:
+            return fh.read()
+    except OSError as e:
+        return e
+
+def prefetch_files(paths: List[str], chunk: int = READ_CHUNK) -> Iterator[Tuple[str, Any]]:
+    """
+    Yield (path, bytes or OSError) in order, reading the next chunk of files
+    on a small I/O pool while the caller processes the current one.
+    """
+    global _IO_POOL
+    if _IO_POOL is None:
+        _IO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="deepface-io")
+    chunks = [paths[i:i + chunk] for i in range(0, len(paths), chunk)]
+    pending = [_IO_POOL.submit(_read_file, p) for p in chunks[0]] if chunks else []
+    for i, current in enumerate(chunks):
+        futures = pending
+        pending = [_IO_POOL.submit(_read_file, p) for p in chunks[i + 1]] if i + 1 < len(chunks) else []
+        for path, fut in zip(current, futures):
+            yield path, fut.result()
+
+# ----------------------------
+# Model cache (built once per process)
+# ----------------------------
+_MODEL_CACHE: Dict[str, Any] = {}
+_DETECTOR_CACHE: Dict[str, Any] = {}
+# executor threads may fill the module-level caches concurrently: each model,
+# detector, DB and index is built under its own lock, so a slow gallery build
+# never blocks requests that need something else
+_KEY_LOCKS: Dict[Any, threading.RLock] = {}
+_KEY_LOCKS_GUARD = threading.Lock()
+
+def _key_lock(*key: Any) -> threading.RLock:
+    """The lock guarding the cache slot for key (created on first use)."""
+    with _KEY_LOCKS_GUARD:
+        lock = _KEY_LOCKS.get(key)
+        if lock is None:
+            lock = _KEY_LOCKS[key] = threading.RLock()
+        return lock
+
+def get_model(model_name: str) -> Any:
+    """Return the recognition model for model_name, building it on first use."""
+    model = _MODEL_CACHE.get(model_name)
+    if model is None:
+        with _key_lock("model", model_name):
+            model = _MODEL_CACHE.get(model_name)
+            if model is None:
+                model = _MODEL_CACHE[model_name] = DeepFace.build_model(model_name)
+    return model
+
+def get_detector(detector: str) -> Any:
+    """Return the face detector backend, building it on first use (None for 'skip')."""
+    if not detector or detector == "skip":
+        return None
+    if detector not in _DETECTOR_CACHE:
+        with _key_lock("detector", detector):
+            if detector not in _DETECTOR_CACHE:
+                try:
+                    from deepface.modules import modeling
+                    built = modeling.build_model(task="face_detector", model_name=detector)
+                except (ImportError, TypeError):
+                    from deepface.detectors import FaceDetector
+                    built = FaceDetector.build_model(detector)
+                _DETECTOR_CACHE[detector] = built
+    return _DETECTOR_CACHE[detector]
+
+# ----------------------------
+# DB embedding cache (find)
+# ----------------------------
+DEFAULT_MODEL = "VGG-Face"
+DEFAULT_DETECTOR = "opencv"
+IMG_EXTS = (".jpg", ".jpeg", ".png")
+TOP_K = 10
+ANN_MIN_SIZE = 1000   # below this a brute-force scan beats the index overhead
+INDEX_BACKENDS = ("auto", "hnsw", "faiss", "brute")
+DB_RESCAN_S = 1.0     # finds within this long of the last scan reuse the cached DB as is
+
+# (db_path, model, detector) -> {"stats": {path: (mtime, size)}, "paths": [...], "embs": [N,D] float32 (maybe mmap),
+#                                "failed": {path: (mtime, size)} of images that could not be embedded}
+_DB_CACHE: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+# (db_path, model, detector, quantize) -> (cache entry the index was built from, faiss.Index)
+_FAISS_INDEX: Dict[Tuple[str, str, str, bool], Tuple[Dict[str, Any], Any]] = {}
+_HNSW_INDEX: Dict[Tuple[str, str, str], Tuple[Dict[str, Any], Any]] = {}
+
+def _db_key(db_path: str, model: str, detector: str) -> Tuple[str, str, str]:
+    return (os.path.abspath(db_path), model, detector)
+
+def _sidecar_path(db_path: str, model: str, detector: str, ext: str = ".pkl") -> str:
+    return os.path.join(db_path, f"deepface_cli_{model}_{detector}{ext}".replace("/", "_"))
+
+def _scan_db(db_path: str, stats: Any = None) -> Dict[str, Tuple[float, int]]:
+    """
+    Map every image under db_path to its (mtime, size) signature.
+
+    Uses os.scandir: on Windows DirEntry.stat() comes from the directory
+    listing, so no file is opened.
+    """
+    if stats is None:
+        stats = {}
+    try:
+        with os.scandir(db_path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return stats
+    subdirs = []
+    for e in entries:
+        try:
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.path)
+            elif e.name.lower().endswith(IMG_EXTS):
+                st = e.stat()
+                stats[e.path] = (st.st_mtime, st.st_size)
+        except OSError:
+            continue   # removed while scanning
+    for sub in subdirs:
+        _scan_db(sub, stats)
+    return stats
+
+def _unchanged(entry: Dict[str, Any], stats: Dict[str, Tuple[float, int]]) -> bool:
+    """True if a scan matches entry, ignoring images that already failed with the same signature."""
+    failed = entry.get("failed") or {}
+    if failed:
+        stats = {path: sig for path, sig in stats.items() if failed.get(path) != sig}
+    return entry["stats"] == stats
+
+def _normalize(embs: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so cosine similarity becomes a dot product."""
+    norms = np.linalg.norm(embs, axis=-1, keepdims=True)
+    return (embs / np.maximum(norms, 1e-10)).astype(np.float32)
+
+def _embed(img: Any, model: str, detector: str, enforce_detection: bool) -> List[Dict[str, Any]]:
+    """One DeepFace.represent call; returns one entry per detected face."""
+    get_detector(detector)
+    kwargs = {"img_path": img, "model_name": model, "model": get_model(model),
+              "detector_backend": detector, "enforce_detection": enforce_detection}
+    return safe_call(DeepFace.represent, kwargs)
+
+def _find_threshold(model: str, metric: str = "cosine") -> float:
+    try:
+        from deepface.modules.verification import find_threshold
+    except ImportError:
+        try:
+            from deepface.commons.distance import findThreshold as find_threshold
+        except ImportError:
+            return 0.4
+    return float(find_threshold(model, metric))
+
+def _read_sidecar(path: str) -> Any:
+    """Load a cache entry; its embedding matrix is memory-mapped, not read."""
+    try:
+        with open(path, "rb") as fh:
+            meta = pickle.load(fh)
+        embs = np.load(os.path.join(os.path.dirname(path), meta["npy"]), mmap_mode="r")
+        if embs.shape[0] != len(meta["paths"]):
+            raise ValueError("embedding matrix does not match path list")
+        return {"stats": meta["stats"], "paths": meta["paths"], "embs": embs}
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        eprint(f"[WARN] ignoring unreadable embedding cache {path}: {e}")
+        return None
+
+def _sidecar_npy(path: str) -> Any:
+    """Full path of the .npy the sidecar at path references (None if unreadable)."""
+    try:
+        with open(path, "rb") as fh:
+            return os.path.join(os.path.dirname(path), pickle.load(fh)["npy"])
+    except Exception:
+        return None
+
+def _write_sidecar(path: str, entry: Dict[str, Any]) -> None:
+    """
+    Persist entry as a fixed-shape float32 .npy plus a small .pkl (stats, paths).
+
+    Each build writes a fresh .npy name: on Windows a file that is still
+    memory-mapped (by us or another worker) can't be replaced. Only the .npy
+    the replaced .pkl referenced, and leftovers older than it, are removed, so
+    a concurrent writer's fresh .npy is never deleted under it.
+    """
+    prefix = os.path.splitext(path)[0]
+    npy = f"{prefix}.{uuid.uuid4().hex[:8]}.npy"
+    previous = _sidecar_npy(path)
+    tmp = None
+    try:
+        np.save(npy, np.ascontiguousarray(entry["embs"], dtype=np.float32))
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path) + ".",
+                                   dir=os.path.dirname(path) or None)
+        with os.fdopen(fd, "wb") as fh:
+            pickle.dump({"stats": entry["stats"], "paths": entry["paths"], "npy": os.path.basename(npy)},
+                        fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        eprint(f"[WARN] could not persist embedding cache {path}: {e}")
+        for leftover in (tmp, npy):
+            if leftover:
+                with contextlib.suppress(OSError):
+                    os.remove(leftover)
+        return
+    if previous is None or previous == npy:
+        return
+    try:
+        cutoff = os.path.getmtime(previous)
+    except OSError:
+        return
+    current = _sidecar_npy(path)
+    for old in glob.glob(glob.escape(prefix) + ".*.npy"):
+        if old in (npy, current):
+            continue
+        with contextlib.suppress(OSError):
+            if old == previous or os.path.getmtime(old) < cutoff:
+                os.remove(old)
+
+def load_db(db_path: str, model: str, detector: str) -> Dict[str, Any]:
+    """Thread-safe entry point to _load_db (one build or rescan per DB at a time)."""
+    with _key_lock("db", *_db_key(db_path, model, detector)):
+        return _load_db(db_path, model, detector)
+
+def _load_db(db_path: str, model: str, detector: str) -> Dict[str, Any]:
+    """
+    Return the cached embeddings of every face in db_path.
+
+    Images whose (mtime, size) did not change since the last build reuse their
+    embeddings; only new or modified images go through DeepFace.represent.
+    Kept rows stay in their previous order and new rows are appended, so an
+    index built on the old entry can be extended instead of rebuilt.
+    Entries loaded from disk are memory-mapped, so a restart costs no read.
+    Images that fail to embed are remembered by signature and only retried
+    once they change (or after a restart); until then the entry is reused.
+    """
+    key = _db_key(db_path, model, detector)
+    db_path = key[0]
+    entry = _DB_CACHE.get(key)
+    now = time.monotonic()
+    if entry is not None and now - entry.get("scanned", 0.0) < DB_RESCAN_S:
+        return entry
+
+    stats = _scan_db(db_path)
+    if entry is not None and _unchanged(entry, stats):
+        entry["scanned"] = now
+        return entry
+
+    sidecar = _sidecar_path(db_path, model, detector)
+    if entry is None:
+        entry = _read_sidecar(sidecar)
+        if entry is not None and entry["stats"] == stats:
+            entry["scanned"] = now
+            _DB_CACHE[key] = entry
+            return entry
+
+    paths: List[str] = []
+    keep: List[int] = []
+    known = set()
+    failed = {}
+    if entry is not None:
+        known = {path for path, sig in stats.items() if entry["stats"].get(path) == sig}
+        # unchanged images that failed before are not worth another try
+        failed = {path: sig for path, sig in (entry.get("failed") or {}).items() if stats.get(path) == sig}
+        for i, path in enumerate(entry["paths"]):
+            if path in known:
+                keep.append(i)
+                paths.append(path)
+
+    rows: List[np.ndarray] = []
+    todo = [p for p in stats if p not in known and p not in failed]
+    new_failures = 0
+    for path, data in prefetch_files(todo):
+        try:
+            if isinstance(data, Exception):
+                raise data
+            reps = _embed(decode_image(data, path), model, detector, False)
+        except Exception as e:
+            eprint(f"[WARN] skipping {path}: {e}")
+            failed[path] = stats[path]
+            new_failures += 1
+            continue
+        for rep in reps:
+            rows.append(_normalize(np.asarray(rep["embedding"], dtype=np.float32)))
+            paths.append(path)
+
+    parts = []
+    if keep:
+        parts.append(np.asarray(entry["embs"][keep], dtype=np.float32))   # one copy out of the mmap
+    if rows:
+        parts.append(np.stack(rows))
+    embs = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+    # failed images stay out of stats (and the sidecar) so a restart retries them
+    for path in failed:
+        del stats[path]
+    entry = {"stats": stats, "paths": paths, "embs": embs, "failed": failed, "scanned": now}
+    _DB_CACHE[key] = entry
+    if not todo or new_failures < len(todo):
+        _write_sidecar(sidecar, entry)
+    return entry
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=not getattr(sys, "frozen", False))
+    def _dot_scan(db, q, out):
+        """out[i] = db[i] . q, fused and multithreaded over rows."""
+        n, d = db.shape
+        for i in prange(n):
+            s = 0.0
+            for j in range(d):
+                s += db[i, j] * q[j]
+            out[i] = s
+else:
+    _dot_scan = None
+
+# numba's fallback "workqueue" threading layer aborts the process on concurrent
+# parallel calls; the kernel already uses every core, so serialize callers.
+_SCAN_LOCK = threading.Lock()
+
+def _row_sigs(entry: Dict[str, Any]) -> List[Tuple[str, Tuple[float, int]]]:
+    """(path, (mtime, size)) of the image behind every embedding row."""
+    return [(path, entry["stats"][path]) for path in entry["paths"]]
+
+def _fingerprint(entry: Dict[str, Any]) -> str:
+    """Identify the exact row layout of an entry; persisted indexes are only reused on a match."""
+    if "fingerprint" not in entry:
+        entry["fingerprint"] = hashlib.sha1(repr(_row_sigs(entry)).encode("utf-8")).hexdigest()
+    return entry["fingerprint"]
+
+def _read_fingerprint(index_path: str) -> Any:
+    try:
+        with open(index_path + ".fp", "r", encoding="ascii") as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+def _save_index(index_path: str, entry: Dict[str, Any], save) -> None:
+    """Write an index with save(index_path), then the fingerprint of the entry it was built from."""
+    try:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(index_path + ".fp")   # never leave an old fingerprint next to a new index
+        save(index_path)
+        with open(index_path + ".fp", "w", encoding="ascii") as fh:
+            fh.write(_fingerprint(entry))
+    except Exception as e:
+        eprint(f"[WARN] could not persist index {index_path}: {e}")
+
+def _faiss_index(key: Tuple[str, str, str], entry: Dict[str, Any], quantize: bool = False) -> Any:
+    """
+    Build (once per cache entry) an inner-product IVF index over the DB.
+
+    With quantize, vectors are stored as 8-bit scalar-quantized codes (4x less
+    memory than float32); queries stay float32 (asymmetric distance).
+    The index is written next to the embedding sidecar and reloaded on restart
+    when its fingerprint matches the entry's rows.
+    """
+    cached = _FAISS_INDEX.get(key + (quantize,))
+    if cached is not None and cached[0] is entry:
+        return cached[1]
+
+    embs = np.ascontiguousarray(entry["embs"], dtype=np.float32)   # rows already L2-normalized
+    n, d = embs.shape
+    path = _sidecar_path(*key, ext=".ivf8" if quantize else ".ivf")
+    index = None
+    if cached is None and os.path.exists(path) and _read_fingerprint(path) == _fingerprint(entry):
+        try:
+            index = faiss.read_index(path)
+            if index.ntotal != n or index.d != d:
+                index = None
+        except Exception as e:
+            eprint(f"[WARN] ignoring unreadable FAISS index {path}: {e}")
+            index = None
+
+    nlist = max(1, int(4 * math.sqrt(n)))
+    if index is None:
+        quantizer = faiss.IndexFlatIP(d)
+        if quantize:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, faiss.ScalarQuantizer.QT_8bit,
+                                                  faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(embs)
+        index.add(embs)
+        _save_index(path, entry, lambda p: faiss.write_index(index, p))
+    index.nprobe = max(1, int(math.sqrt(nlist)))
+    _FAISS_INDEX[key + (quantize,)] = (entry, index)
+    return index
+
+def _hnsw_index(key: Tuple[str, str, str], entry: Dict[str, Any]) -> Any:
+    """
+    HNSW index over the DB, persisted next to the embedding sidecar.
+
+    When the entry only gained rows since the index was built, the new rows are
+    inserted incrementally; any other change rebuilds the graph. A saved graph
+    is reused only when its fingerprint matches the entry's rows.
+    """
+    cached = _HNSW_INDEX.get(key)
+    if cached is not None and cached[0] is entry:
+        return cached[1]
+
+    embs = entry["embs"]
+    n, d = embs.shape
+    path = _sidecar_path(*key, ext=".hnsw")
+    index = None
+    if cached is not None:
+        old_entry, old_index = cached
+        m = len(old_entry["paths"])
+        # compare (path, stat) per row: a modified last image keeps the same path order
+        if m <= n and old_index.dim == d and _row_sigs(entry)[:m] == _row_sigs(old_entry):
+            index = old_index
+    elif os.path.exists(path) and _read_fingerprint(path) == _fingerprint(entry):
+        try:
+            index = hnswlib.Index(space="cosine", dim=d)
+            index.load_index(path, max_elements=n)
+            if index.get_current_count() != n:
+                index = None
+        except Exception as e:
+            eprint(f"[WARN] ignoring unreadable HNSW index {path}: {e}")
+            index = None
+
+    start = index.get_current_count() if index is not None else 0
+    if index is None:
+        index = hnswlib.Index(space="cosine", dim=d)
+        index.init_index(max_elements=n, ef_construction=200, M=16)
+    elif start < n:
+        index.resize_index(n)
+    if start < n:
+        index.add_items(embs[start:], np.arange(start, n))
+        _save_index(path, entry, index.save_index)
+
+    _HNSW_INDEX[key] = (entry, index)
+    return index
+
+def _check_index(index: str, quantize: bool) -> None:
+    """
+    Reject unknown index backends, and quantize with one that can't honour it.
+
+    quantize only applies to FAISS; DBs under ANN_MIN_SIZE faces (or without
+    FAISS installed) are still scanned as float32.
+    """
+    if index not in INDEX_BACKENDS:
+        raise ValueError(f"Unsupported index '{index}' (expected one of {', '.join(INDEX_BACKENDS)})")
+    if quantize and index not in ("auto", "faiss"):
+        raise ValueError(f"quantize requires index 'faiss' or 'auto' (got '{index}')")
+
+def _ann_backend(index: str, n: int, quantize: bool = False) -> str:
+    """Resolve the requested index backend against DB size and installed libs."""
+    if n < ANN_MIN_SIZE or index == "brute":
+        return "brute"
+    if quantize and index == "auto" and faiss is not None:
+        return "faiss"   # only FAISS stores int8 codes
+    if index in ("auto", "hnsw") and hnswlib is not None:
+        return "hnsw"
+    if index in ("auto", "faiss") and faiss is not None:
+        return "faiss"
+    return "brute"
+
+def _search(key: Tuple[str, str, str], entry: Dict[str, Any], q: np.ndarray, k: int,
+            index: str = "auto", quantize: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k cosine similarities and row indices of q against the DB, best first."""
+    n = len(entry["paths"])
+    k = min(k, n)
+    backend = _ann_backend(index, n, quantize)
+    if backend == "hnsw":
+        # hnswlib can't search while _hnsw_index resizes/extends the same graph
+        with _key_lock("hnsw", *key):
+            p = _hnsw_index(key, entry)
+            p.set_ef(max(50, k))
+            labels, dists = p.knn_query(q[None, :], k=k)
+        return 1.0 - dists[0], labels[0].astype(np.int64)
+    if backend == "faiss":
+        with _key_lock("faiss", *key, quantize):
+            f = _faiss_index(key, entry, quantize)
+        sims, idx = f.search(q[None, :], k)
+        keep = idx[0] >= 0
+        return sims[0][keep], idx[0][keep]
+
+    # rows are pre-normalized at cache-build time, so cosine == dot product
+    if _dot_scan is not None:
+        sims = np.empty(n, dtype=np.float32)
+        with _SCAN_LOCK:
+            _dot_scan(np.ascontiguousarray(entry["embs"]), q, sims)
+    else:
+        sims = entry["embs"] @ q
+    idx = np.argpartition(-sims, k - 1)[:k]
+    idx = idx[np.argsort(-sims[idx])]
+    return sims[idx], idx
+
+def embed_batch(imgs: List[Any], model: str, detector: str, enforce_detection: bool) -> List[Any]:
+    """
+    Embed several query images, with a single DeepFace.represent call when the
+    installed DeepFace accepts a list of images.
+
+    Returns one entry per image: its list of face representations, or the
+    exception raised for that image.
+    """
+    imgs = [load_image(img) for img in imgs]
+    if len(imgs) > 1:
+        try:
+            out = _embed(list(imgs), model, detector, enforce_detection)
+            if len(out) == len(imgs) and all(isinstance(r, list) for r in out):
+                return out
+        except Exception:
+            pass   # older DeepFace, or one bad image: retry one by one
+
+    results = []
+    for img in imgs:
+        try:
+            results.append(_embed(img, model, detector, enforce_detection))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def match_reps(reps: List[Dict[str, Any]], db_path: str, model: str, detector: str,
+               top_k: int = TOP_K, index: str = "auto", quantize: bool = False) -> List[List[Dict[str, Any]]]:
+    """Match already-embedded query faces against the cached DB embeddings."""
+    if top_k < 1:
+        raise ValueError(f"top_k must be >= 1 (got {top_k})")
+    _check_index(index, quantize)
+    key = _db_key(db_path, model, detector)
+    entry = load_db(db_path, model, detector)
+    threshold = _find_threshold(model)
+
+    results = []
+    for rep in reps:
+        area = rep.get("facial_area") or {}
+        source = {f"source_{k}": area.get(k) for k in ("x", "y", "w", "h")}
+        if not entry["paths"]:
+            results.append([])
+            continue
+        q = _normalize(np.asarray(rep["embedding"], dtype=np.float32))
+        sims, idx = _search(key, entry, q, top_k, index, quantize)
+        results.append([
+            {"identity": entry["paths"][i], **source, "threshold": threshold, "distance": float(1.0 - sim)}
+            for sim, i in zip(sims, idx) if 1.0 - sim <= threshold
+        ])
+    return results
+
+def find_cached(img: Any, db_path: str, model: str = None, detector: str = None,
+                enforce_detection: bool = False, top_k: int = TOP_K,
+                index: str = "auto", quantize: bool = False) -> List[List[Dict[str, Any]]]:
+    """
+    Drop-in for DeepFace.find backed by the DB embedding cache.
+
+    Only the query image is embedded; each detected face gets up to top_k
+    matches (closest first) with DeepFace.find's identity/source/distance fields.
+    """
+    model = model or DEFAULT_MODEL
+    detector = detector or DEFAULT_DETECTOR
+    reps = _embed(load_image(img), model, detector, enforce_detection)
+    return match_reps(reps, db_path, model, detector, top_k, index, quantize)
+
 # ----------------------------
 # Command handlers (single-frame only)
 # ----------------------------
-def cmd_analyze(args_or_req) -> Any:
+@contextlib.contextmanager
+def shm_frame(spec: Dict[str, Any]) -> Iterator[np.ndarray]:
+    """Map a frame_shm spec {"name", "shape", "dtype"} to a zero-copy ndarray view."""
+    if not isinstance(spec, dict) or not spec.get("name") or not spec.get("shape"):
+        raise ValueError("frame_shm requires name and shape")
+    try:
+        shm = shared_memory.SharedMemory(name=spec["name"], track=False)   # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=spec["name"])
+        if os.name == "posix":
+            # the writer owns the block: don't let our resource tracker unlink it at exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        yield np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec.get("dtype", "uint8")), buffer=shm.buf)
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass   # a view is still referenced; the mapping closes when it is collected
+
+@contextlib.contextmanager
+def open_frame(frame: Any, frame_shm: Dict[str, Any] = None) -> Iterator[Any]:
+    """Yield what to pass as DeepFace img_path: the shm view if given, else the (decoded) path."""
+    if frame_shm:
+        with shm_frame(frame_shm) as arr:
+            yield arr
+            del arr   # drop our view so the mapping can close
+    else:
+        yield load_image(frame)
+
+def _face_to_uint8(face: Any) -> Any:
+    """Downcast a float face crop (0-1 or 0-255) to uint8 to shrink the JSON payload."""
+    if isinstance(face, np.ndarray) and face.dtype.kind == "f":
+        scale = 255.0 if face.size and face.max() <= 1.0 else 1.0
+        return np.clip(face * scale, 0, 255).round().astype(np.uint8)
+    return face
+
+def cmd_analyze(req: Dict[str, Any]) -> Any:
     """
     Analyze a single frame.
 
@@ -118,157 +873,376 @@ def cmd_analyze(args_or_req) -> Any:
         model: optional model name
         enforce_detection: bool
     """
-    if isinstance(args_or_req, argparse.Namespace):
-        frame = getattr(args_or_req, "frame", None)
-        if not frame and getattr(args_or_req, "frames", None):
-            frame = args_or_req.frames[0]
-        actions = getattr(args_or_req, "actions", None)
-        detector = getattr(args_or_req, "detector", None)
-        enforce_detection = getattr(args_or_req, "enforce_detection", False)
-        model = getattr(args_or_req, "model", None)
-    elif isinstance(args_or_req, dict):
-        frame = args_or_req.get("frame") or (args_or_req.get("frames") or [None])[0]
-        actions = args_or_req.get("actions")
-        detector = args_or_req.get("detector")
-        enforce_detection = args_or_req.get("enforce_detection", False)
-        model = args_or_req.get("model")
-    else:
-        raise ValueError("Unsupported input type for cmd_analyze")
+    frame = req.get("frame") or (req.get("frames") or [None])[0]
+    frame_shm = req.get("frame_shm")
+    actions = req.get("actions")
+    detector = req.get("detector")
+    model = req.get("model")
 
-    if not frame:
+    if not frame and not frame_shm:
         raise ValueError("No frame provided")
 
-    kwargs = {"img_path": frame, "enforce_detection": enforce_detection}
+    kwargs = {"enforce_detection": req.get("enforce_detection", False)}
     if actions:
         kwargs["actions"] = [a.strip() for a in actions.split(",") if a.strip()]
     if detector:
+        get_detector(detector)
         kwargs["detector_backend"] = detector
     if model:
         kwargs["model_name"] = model
         kwargs["model"] = model
 
-    return {"frame": frame, "result": safe_call(DeepFace.analyze, kwargs)}
+    with open_frame(frame, frame_shm) as img:
+        kwargs["img_path"] = img
+        result = safe_call(DeepFace.analyze, kwargs)
+        del kwargs["img_path"]
+    return {"frame": frame or frame_shm["name"], "result": result}
 
-def cmd_verify(args_or_req) -> Any:
+def cmd_verify(req: Dict[str, Any]) -> Any:
     """Verify: compare two images."""
-    if isinstance(args_or_req, argparse.Namespace):
-        img1 = getattr(args_or_req, "img1", None)
-        img2 = getattr(args_or_req, "img2", None)
-        detector = getattr(args_or_req, "detector", None)
-        enforce_detection = getattr(args_or_req, "enforce_detection", False)
-        model = getattr(args_or_req, "model", None)
-    elif isinstance(args_or_req, dict):
-        img1 = args_or_req.get("img1")
-        img2 = args_or_req.get("img2")
-        detector = args_or_req.get("detector")
-        enforce_detection = args_or_req.get("enforce_detection", False)
-        model = args_or_req.get("model")
-    else:
-        raise ValueError("Unsupported input type for cmd_verify")
+    img1 = req.get("img1")
+    img2 = req.get("img2")
+    detector = req.get("detector")
+    model = req.get("model")
 
     if not img1 or not img2:
         raise ValueError("verify requires img1 and img2")
 
-    kwargs = {"img1_path": img1, "img2_path": img2, "enforce_detection": enforce_detection}
+    kwargs = {"img1_path": load_image(img1), "img2_path": load_image(img2), "enforce_detection": req.get("enforce_detection", False)}
     if detector:
+        get_detector(detector)
         kwargs["detector_backend"] = detector
     if model:
         kwargs["model_name"] = model
-        kwargs["model"] = model
+        kwargs["model"] = get_model(model)
 
     return safe_call(DeepFace.verify, kwargs)
 
-def cmd_detect(args_or_req) -> Any:
+def cmd_detect(req: Dict[str, Any]) -> Any:
     """Detect faces from a single frame."""
-    if isinstance(args_or_req, argparse.Namespace):
-        frame = getattr(args_or_req, "frame", None) or (getattr(args_or_req, "frames", None) or [None])[0]
-        detector = getattr(args_or_req, "detector", None)
-        enforce_detection = getattr(args_or_req, "enforce_detection", False)
-    elif isinstance(args_or_req, dict):
-        frame = args_or_req.get("frame") or (args_or_req.get("frames") or [None])[0]
-        detector = args_or_req.get("detector")
-        enforce_detection = args_or_req.get("enforce_detection", False)
-    else:
-        raise ValueError("Unsupported input type for cmd_detect")
+    frame = req.get("frame") or (req.get("frames") or [None])[0]
+    frame_shm = req.get("frame_shm")
+    detector = req.get("detector")
 
-    if not frame:
+    if not frame and not frame_shm:
         raise ValueError("No frame provided")
 
-    return {"frame": frame, "faces": safe_call(DeepFace.extract_faces, {"img_path": frame, "detector_backend": detector, "enforce_detection": enforce_detection})}
+    get_detector(detector)
+    with open_frame(frame, frame_shm) as img:
+        faces = safe_call(DeepFace.extract_faces, {"img_path": img, "detector_backend": detector,
+                                                   "enforce_detection": req.get("enforce_detection", False)})
+        del img
+    for face in faces:
+        if isinstance(face, dict) and "face" in face:
+            face["face"] = _face_to_uint8(face["face"])
+    return {"frame": frame or frame_shm["name"], "faces": faces}
 
-def cmd_find(args_or_req) -> Any:
-    """Find: search a database for similar faces from a single frame."""
-    if isinstance(args_or_req, argparse.Namespace):
-        img = getattr(args_or_req, "img", None)
-        db = getattr(args_or_req, "db", None)
-        detector = getattr(args_or_req, "detector", None)
-        enforce_detection = getattr(args_or_req, "enforce_detection", False)
-        model = getattr(args_or_req, "model", None)
-    elif isinstance(args_or_req, dict):
-        img = args_or_req.get("img")
-        db = args_or_req.get("db")
-        detector = args_or_req.get("detector")
-        enforce_detection = args_or_req.get("enforce_detection", False)
-        model = args_or_req.get("model")
-    else:
-        raise ValueError("Unsupported input type for cmd_find")
+def _top_k(req: Dict[str, Any]) -> int:
+    """Read and validate a request's top_k (TOP_K when absent)."""
+    top_k = req.get("top_k")
+    top_k = TOP_K if top_k is None else int(top_k)
+    if top_k < 1:
+        raise ValueError(f"top_k must be >= 1 (got {top_k})")
+    return top_k
+
+def _find_args(req: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a find request into find_cached keyword arguments."""
+    img = req.get("img")
+    db = req.get("db")
+    index = req.get("index") or "auto"
+
+    quantize = bool(req.get("quantize", False))
 
     if not img or not db:
         raise ValueError("find requires img and db")
+    _check_index(index, quantize)
+    top_k = _top_k(req)
 
-    kwargs = {"img_path": img, "db_path": db, "enforce_detection": enforce_detection}
-    if detector:
-        kwargs["detector_backend"] = detector
-    if model:
-        kwargs["model_name"] = model
-        kwargs["model"] = model
+    return {"img": img, "db_path": db,
+            "model": req.get("model") or DEFAULT_MODEL,
+            "detector": req.get("detector") or DEFAULT_DETECTOR,
+            "enforce_detection": req.get("enforce_detection", False),
+            "top_k": top_k,
+            "index": index,
+            "quantize": quantize}
 
-    return safe_call(DeepFace.find, kwargs)
+def cmd_find(req: Dict[str, Any]) -> Any:
+    """Find: search a database for similar faces from a single frame."""
+    return find_cached(**_find_args(req))
 
-def cmd_test(_args=None) -> Any:
+PIPELINE_OPS = ("detect", "analyze", "find")
+
+def _face_to_bgr(face: Any) -> np.ndarray:
+    """extract_faces crops are RGB (float 0-1); DeepFace array inputs are BGR."""
+    return np.ascontiguousarray(_face_to_uint8(np.asarray(face))[:, :, ::-1])
+
+def cmd_pipeline(req: Dict[str, Any]) -> Any:
+    """
+    Detect faces once, then run each requested op on the crops.
+
+    Args:
+        frame / frame_shm: image, as for analyze
+        ops: list or "detect,analyze,find" (default detect,analyze)
+        actions, model, detector, enforce_detection: as for analyze/find
+        db, top_k, index, quantize: as for find (db required with "find")
+    """
+    frame = req.get("frame") or (req.get("frames") or [None])[0]
+    frame_shm = req.get("frame_shm")
+    ops = req.get("ops") or ["detect", "analyze"]
+    if isinstance(ops, str):
+        ops = [o.strip() for o in ops.split(",") if o.strip()]
+    actions = req.get("actions")
+    model = req.get("model") or DEFAULT_MODEL
+    detector = req.get("detector") or DEFAULT_DETECTOR
+    db = req.get("db")
+    index = req.get("index") or "auto"
+    quantize = bool(req.get("quantize", False))
+
+    if not frame and not frame_shm:
+        raise ValueError("No frame provided")
+    unknown = [o for o in ops if o not in PIPELINE_OPS]
+    if unknown:
+        raise ValueError(f"Unsupported pipeline ops {unknown} (expected {', '.join(PIPELINE_OPS)})")
+    if "find" in ops and not db:
+        raise ValueError("pipeline op 'find' requires db")
+    _check_index(index, quantize)
+    top_k = _top_k(req)
+
+    get_detector(detector)
+    with open_frame(frame, frame_shm) as img:
+        faces = safe_call(DeepFace.extract_faces, {"img_path": img, "detector_backend": detector,
+                                                   "enforce_detection": req.get("enforce_detection", False)})
+        del img
+
+    results = []
+    for face in faces:
+        crop = _face_to_bgr(face["face"])
+        item = {"facial_area": face.get("facial_area"), "confidence": face.get("confidence")}
+        if "detect" in ops:
+            item["face"] = _face_to_uint8(face["face"])
+        if "analyze" in ops:
+            kwargs = {"img_path": crop, "detector_backend": "skip", "enforce_detection": False}
+            if actions:
+                kwargs["actions"] = [a.strip() for a in actions.split(",") if a.strip()]
+            analysis = safe_call(DeepFace.analyze, kwargs)
+            item["analyze"] = analysis[0] if isinstance(analysis, list) and analysis else analysis
+        if "find" in ops:
+            reps = _embed(crop, model, "skip", False)
+            for rep in reps:
+                rep["facial_area"] = face.get("facial_area")   # report source coords in the full frame
+            # the DB itself stays embedded with the real detector
+            matches = match_reps(reps, db, model, detector, top_k, index, quantize)
+            item["find"] = matches[0] if matches else []
+        results.append(item)
+    return {"frame": frame or frame_shm["name"], "ops": ops, "faces": results}
+
+def cmd_test(_req: Dict[str, Any] = None) -> Any:
     """Simple health-check command for the server; returns 'ok'."""
     return "ok"
 
+# ----------------------------
+# Worker pool
+# ----------------------------
+_EXECUTOR: concurrent.futures.Executor = None
+_SHM_ENABLED = False
+
+def _init_worker(model: str = None, detector: str = None):
+    """Preload the serve-time model/detector (once per pool process)."""
+    if model:
+        get_model(model)
+    if detector:
+        get_detector(detector)
+
+def make_executor(kind: str, workers: int, model: str = None, detector: str = None) -> concurrent.futures.Executor:
+    """
+    Pool used by the WebSocket server for DeepFace calls.
+
+    Threads share one copy of every model (TF releases the GIL for most ops);
+    processes give true CPU parallelism at the cost of one model per worker.
+    """
+    if kind == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                      initargs=(model, detector))
+    _init_worker(model, detector)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deepface")
+
+async def run_blocking(func, *args) -> Any:
+    """Run a blocking DeepFace call on _EXECUTOR (inline when no pool is set)."""
+    if _EXECUTOR is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, func, *args)
+
+# ----------------------------
+# Request batching (find)
+# ----------------------------
+MAX_BATCH = 8
+MAX_LATENCY_MS = 10
+# (img, model, detector, enforce_detection, future) waiting for a query embedding
+_BATCH_QUEUE: asyncio.Queue = None
+_BATCH_TASKS: set = set()   # strong refs so in-flight tasks are not garbage-collected
+_FINDS_ACTIVE = 0   # batched finds between enqueue and reply (event-loop thread only)
+
+async def _embed_group(items: List[tuple]):
+    _, model, detector, enforce_detection, _ = items[0]
+    try:
+        results = await run_blocking(embed_batch, [it[0] for it in items], model, detector, enforce_detection)
+    except Exception as e:
+        results = [e] * len(items)
+    for item, res in zip(items, results):
+        fut = item[-1]
+        if fut.done():
+            continue
+        if isinstance(res, Exception):
+            fut.set_exception(res)
+        else:
+            fut.set_result(res)
+
+async def batch_worker(max_latency_ms: float = MAX_LATENCY_MS):
+    """
+    Coalesce find query embeddings that arrive within max_latency_ms of each
+    other (up to MAX_BATCH) into one DeepFace.represent call per model/detector.
+
+    The window is only waited out while other finds are active; a lone find
+    (e.g. a client with one request in flight) is embedded immediately.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _BATCH_QUEUE.get()]
+        deadline = loop.time() + max_latency_ms / 1000.0
+        while len(batch) < MAX_BATCH:
+            if _BATCH_QUEUE.empty() and _FINDS_ACTIVE <= len(batch):
+                break   # nobody else could join this batch
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_BATCH_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        groups: Dict[tuple, List[tuple]] = {}
+        for item in batch:
+            groups.setdefault(item[1:4], []).append(item)
+        for items in groups.values():
+            task = asyncio.ensure_future(_embed_group(items))
+            _BATCH_TASKS.add(task)
+            task.add_done_callback(_BATCH_TASKS.discard)
+
+async def find_batched(req: Dict[str, Any]) -> Any:
+    """find with its query embedding routed through the batcher (direct when batching is off)."""
+    if _BATCH_QUEUE is None:
+        return await run_blocking(cmd_find, req)
+    global _FINDS_ACTIVE
+    args = _find_args(req)
+    fut = asyncio.get_running_loop().create_future()
+    _FINDS_ACTIVE += 1
+    try:
+        await _BATCH_QUEUE.put((args["img"], args["model"], args["detector"], args["enforce_detection"], fut))
+        reps = await fut
+        return await run_blocking(match_reps, reps, args["db_path"], args["model"], args["detector"],
+                                  args["top_k"], args["index"], args["quantize"])
+    finally:
+        _FINDS_ACTIVE -= 1
+
+# ----------------------------
+# Command routing (serve mode)
+# ----------------------------
+def _pooled(handler):
+    """Wrap a blocking cmd_* handler so it runs on the worker pool."""
+    async def run(req: Dict[str, Any]) -> Any:
+        return await run_blocking(handler, req)
+    return run
+
+async def _inline(req: Dict[str, Any]) -> Any:
+    return cmd_test(req)
+
+# cmd -> async handler(req)
+_CMD_TABLE = {
+    "analyze": _pooled(cmd_analyze),
+    "verify":  _pooled(cmd_verify),
+    "detect":  _pooled(cmd_detect),
+    "find":    find_batched,
+    "pipeline": _pooled(cmd_pipeline),
+    "test":    _inline,
+}
+
 # ----------------------------
 # WebSocket server
 # ----------------------------
+# Precomputed replies. serde_json clients (like the Tauri side) sort keys, so a
+# ping arrives as {"cmd":"test","requestId":N} and is answered without a JSON parse.
+_TEST_PINGS = {'{"cmd":"test"}', '{"cmd": "test"}'}
+_TEST_PING_PREFIX = '{"cmd":"test","requestId":'
+_TEST_RESP_TEMPLATE = b'{"requestId":%s,"status":"ok","command":"test","data":"ok"}'
+_TEST_RESP_NO_ID = _TEST_RESP_TEMPLATE % b"null"
+_INVALID_JSON_RESP = json.dumps({"status": "error", "message": "Invalid JSON"}).encode("utf-8")
+_SEND_TEXT_BYTES = True   # cleared if websockets predates send(..., text=True)
+
+async def send_text(ws, payload: bytes):
+    """
+    Send UTF-8 JSON bytes as a text frame (the Tauri client only accepts text).
+
+    websockets >= 14 frames bytes as text without a decode/encode round trip;
+    older releases get a str.
+    """
+    global _SEND_TEXT_BYTES
+    if _SEND_TEXT_BYTES:
+        try:
+            return await ws.send(payload, text=True)
+        except TypeError:
+            _SEND_TEXT_BYTES = False
+    await ws.send(payload.decode("utf-8"))
+
+def test_fast_path(raw: Any) -> Any:
+    """Return the canned reply bytes if raw is a bare test ping, else None."""
+    if len(raw) > 64:
+        return None
+    if isinstance(raw, (bytes, bytearray)):
+        raw = bytes(raw).decode("latin-1")
+    if raw in _TEST_PINGS:
+        return _TEST_RESP_NO_ID
+    if raw.startswith(_TEST_PING_PREFIX) and raw.endswith("}"):
+        request_id = raw[len(_TEST_PING_PREFIX):-1]
+        # Only plain JSON integers ("0" or no leading zero); anything else
+        # (e.g. "007", "²") takes the normal decode path.
+        if request_id.isascii() and request_id.isdigit() and (request_id == "0" or request_id[0] != "0"):
+            return _TEST_RESP_TEMPLATE % request_id.encode("ascii")
+    return None
+
 async def process_and_respond(ws, req: Dict[str, Any]):
     request_id = req.get("requestId")
     cmd      = req.get("cmd")
 
     try:
+        if "frame_shm" in req and not _SHM_ENABLED:
+            raise ValueError("frame_shm requires the server to run with --shm")
+
         # --- route command ---
-        if cmd == "analyze":
-            res = cmd_analyze(req)
-        elif cmd == "verify":
-            res = cmd_verify(req)
-        elif cmd == "detect":
-            res = cmd_detect(req)
-        elif cmd == "find":
-            res = cmd_find(req)
-        elif cmd == "test":
-            res = cmd_test()
-        else:
+        handler = _CMD_TABLE.get(cmd)
+        if handler is None:
             raise ValueError(f"Unsupported cmd '{cmd}'")
+        res = await handler(req)
 
-        resp = {"requestId": request_id,
-                "status": "ok",
-                "command": cmd,
-                "data": make_serializable(res)}
+        payload = encode_json_bytes({"requestId": request_id,
+                                     "status": "ok",
+                                     "command": cmd,
+                                     "data": res})
 
     except Exception as e:
         # NEVER let the exception reach the event-loop
-        tb = traceback.format_exc()
-        eprint(f"[ERROR] requestId={request_id} cmd={cmd}")
-        eprint(tb)
-        resp = {"requestId": request_id,
-                "status": "error",
-                "command": cmd,
-                "data": {"message": str(e), "traceback": tb}}
+        # formatting the stack is costly; only do it when debugging
+        tb = traceback.format_exc() if DEBUG else None
+        eprint(f"[ERROR] requestId={request_id} cmd={cmd}: {e}")
+        if tb:
+            eprint(tb)
+        payload = encode_json_bytes({"requestId": request_id,
+                                     "status": "error",
+                                     "command": cmd,
+                                     "data": {"message": str(e), "traceback": tb}})
 
     # always send something back
     try:
-        await ws.send(json.dumps(resp, ensure_ascii=False))
+        await send_text(ws, payload)
     except Exception as send_err:
         # even the send might fail if client vanished – log and forget
         eprint(f"[WARN] failed to send response: {send_err}")
@@ -279,10 +1253,17 @@ async def ws_handler(websocket):          # <-- single param
     logging.info("[INFO] WS client connected: %s", client)
     try:
         async for raw in websocket:
+            fast = test_fast_path(raw)
+            if fast is not None:
+                await send_text(websocket, fast)
+                continue
             try:
-                req = json.loads(raw)
+                req = decode_json(raw)
             except json.JSONDecodeError as e:
-                await websocket.send(json.dumps({"status":"error","message":"Invalid JSON"}))
+                await send_text(websocket, _INVALID_JSON_RESP)
+                continue
+            if not isinstance(req, dict):
+                await send_text(websocket, _INVALID_JSON_RESP)
                 continue
             await process_and_respond(websocket, req)
     except websockets.exceptions.ConnectionClosed:
@@ -301,6 +1282,13 @@ def build_parser():
     s = sub.add_parser("serve", help="Run WebSocket server")
     s.add_argument("--host", default="127.0.0.1")
     s.add_argument("--port", type=int, default=8765)
+    s.add_argument("--executor", choices=("thread", "process"), default="thread")
+    s.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    s.add_argument("--model", help="recognition model to preload")
+    s.add_argument("--detector", help="detector backend to preload")
+    s.add_argument("--shm", action="store_true", help="accept frame_shm shared-memory frames")
+    s.add_argument("--batch-ms", dest="batch_ms", type=float, default=MAX_LATENCY_MS,
+                   help="find batching window in ms (0 disables batching)")
 
     # ANALYZE
     a = sub.add_parser("analyze", help="Analyze one frame")
@@ -334,8 +1322,26 @@ def build_parser():
     f.add_argument("--detector")
     f.add_argument("--enforce-detection", dest="enforce_detection", action="store_true")
     f.add_argument("--model")
+    f.add_argument("--top-k", dest="top_k", type=int, default=TOP_K)
+    f.add_argument("--index", choices=INDEX_BACKENDS, default="auto")
+    f.add_argument("--quantize", action="store_true",
+                   help=f"int8 FAISS index for DBs of {ANN_MIN_SIZE}+ faces (index auto/faiss)")
     f.set_defaults(func=cmd_find)
 
+    # PIPELINE
+    pl = sub.add_parser("pipeline", help="Detect once, then run several ops on one frame")
+    pl.add_argument("--frame", required=True)
+    pl.add_argument("--ops", default="detect,analyze", help="comma list of " + ",".join(PIPELINE_OPS))
+    pl.add_argument("--actions")
+    pl.add_argument("--detector")
+    pl.add_argument("--enforce-detection", dest="enforce_detection", action="store_true")
+    pl.add_argument("--model")
+    pl.add_argument("--db")
+    pl.add_argument("--top-k", dest="top_k", type=int, default=TOP_K)
+    pl.add_argument("--index", choices=INDEX_BACKENDS, default="auto")
+    pl.add_argument("--quantize", action="store_true")
+    pl.set_defaults(func=cmd_pipeline)
+
     # TEST
     t = sub.add_parser("test", help="health check")
     t.set_defaults(func=cmd_test)
@@ -347,31 +1353,50 @@ def main():
     args = parser.parse_args()
 
     if args.cmd == "serve":
+        global _EXECUTOR, _SHM_ENABLED
         host = getattr(args, "host", "127.0.0.1")
         port = getattr(args, "port", 8765)
         eprint(f"[INFO] Starting WebSocket server on {host}:{port}")
+        _SHM_ENABLED = args.shm
+        _EXECUTOR = make_executor(args.executor, max(1, args.workers), args.model, args.detector)
         # loop = asyncio.get_event_loop()
         # loop.run_until_complete(websockets.serve(ws_handler, host, port))
         # loop.run_forever()
         # return 0
 
         async def serve():
-            server = await websockets.serve(ws_handler, host, port)
+            global _BATCH_QUEUE
+            if args.batch_ms > 0:
+                _BATCH_QUEUE = asyncio.Queue()
+                _BATCH_TASKS.add(asyncio.ensure_future(batch_worker(args.batch_ms)))
+            # per-message deflate costs more CPU than it saves on small JSON over loopback
+            # write_limit: large find/detect payloads drain without stalling on the default 32 KiB buffer
+            server = await websockets.serve(ws_handler, host, port, compression=None, write_limit=2 ** 20,
+                                            max_queue=128)
             eprint(f"[INFO] WebSocket server started successfully on {host}:{port}")
             await server.wait_closed()
 
+        run = asyncio.run
+        if uvloop is not None:
+            if hasattr(uvloop, "run"):
+                run = uvloop.run
+            else:   # uvloop < 0.18
+                uvloop.install()
         try:
-            asyncio.run(serve())
+            run(serve())
         except KeyboardInterrupt:
             eprint("[INFO] Server stopped by user")
+        finally:
+            _EXECUTOR.shutdown(wait=False, cancel_futures=True)
         return 0
 
 
 
 
     try:
-        result = args.func(args)
-        print(json.dumps(make_serializable(result), ensure_ascii=False))
+        # command handlers take the same dict shape as WS requests
+        result = args.func(vars(args))
+        print(encode_json(result))
         return 0
     except Exception as e:
         eprint("ERROR:", str(e))
@@ -380,4 +1405,5 @@ def main():
         return 2
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()   # process pool under PyInstaller
     raise SystemExit(main())